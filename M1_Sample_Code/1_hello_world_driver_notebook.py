@@ -1,15 +1,27 @@
 # Databricks notebook source
+# DBTITLE 1,Disable progress bars
+# Progress bars are expensive to render in the notebook output stream, so turn them off before installing the wheels
+import os
+os.environ.update({"PIP_PROGRESS_BAR": "off", "HF_HUB_DISABLE_PROGRESS_BARS": "1", "TQDM_DISABLE": "1"})
+
+# COMMAND ----------
+
 # DBTITLE 1,Databricks RAG Studio Installer
 # MAGIC %run ./wheel_installer
 
 # COMMAND ----------
 
-dbutils.library.restartPython()
+# Only restart Python if the installer added or upgraded a package - otherwise nothing already imported in this Python process is stale
+if WHEEL_INSTALL_CHANGED_PACKAGES:
+  dbutils.library.restartPython()
 
 # COMMAND ----------
 
 # DBTITLE 1,Imports
 import os
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import mlflow
 from databricks import rag_studio
 
@@ -17,11 +29,32 @@ from databricks import rag_studio
 from mlflow.utils import databricks_utils as du
 os.environ['MLFLOW_ENABLE_ARTIFACTS_PROGRESS_BAR'] = "false"
 
+# Upload artifacts larger than MLFLOW_MULTIPART_UPLOAD_MINIMUM_FILE_SIZE (500 MB by default) in parallel parts, and give each artifact transfer up to 10 minutes.
+# This chain's artifacts are far smaller than that - it only matters if your chain logs large files.
+os.environ['MLFLOW_ENABLE_MULTIPART_UPLOAD'] = "true"
+os.environ['MLFLOW_ARTIFACT_UPLOAD_DOWNLOAD_TIMEOUT'] = "600"
+
+# Each call into `dbutils.notebook.entry_point` crosses the Py4J bridge, so fetch the notebook context once and reuse it
+@functools.lru_cache(maxsize=None)
+def _nb_context():
+  return dbutils.notebook.entry_point.getDbutils().notebook().getContext()
+
+# Poll `check()` with exponential backoff until it returns True or `timeout` seconds pass
+def _wait_with_backoff(check, initial=1, max_interval=10, timeout=300, factor=1.5):
+  t0 = time.time()
+  delay = initial
+  while time.time() - t0 < timeout:
+    if check():
+      return True
+    time.sleep(delay)
+    delay = min(delay * factor, max_interval)
+  return False
+
+# The workspace hostname doesn't change, so `_BROWSER_URL` is looked up once (in the "Log the model" cell) rather than on every parse_deployment_info call
 def parse_deployment_info(deployment_info):
-  browser_url = du.get_browser_hostname()
   message = f"""Deployment of {deployment_info.model_name} version {deployment_info.model_version} initiated.  This can take up to 15 minutes and the Review App & REST API will not work until this deployment finishes. 
 
-  View status: https://{browser_url}/ml/endpoints/{deployment_info.endpoint_name}
+  View status: https://{_BROWSER_URL}/ml/endpoints/{deployment_info.endpoint_name}
   Review App: {deployment_info.rag_app_url}"""
   return message
 ### END: Ignore this code, temporary workarounds given the Private Preview state of the product
@@ -35,13 +68,28 @@ def parse_deployment_info(deployment_info):
 
 # Assuming your chain notebook is in the current directory, this helper line grabs the current path, prepending /Workspace/
 # Limitation: RAG Studio does not support logging chains stored in Repos
-current_path = '/Workspace' + os.path.dirname(dbutils.notebook.entry_point.getDbutils().notebook().getContext().notebookPath().get())
+ctx = _nb_context()
+current_path = '/Workspace' + os.path.dirname(ctx.notebookPath().get())
 
 chain_notebook_file = "1_hello_world_chain"
 chain_notebook_path = f"{current_path}/{chain_notebook_file}"
 
 print(f"Saving chain from: {chain_notebook_path}")
 
+############
+# Unity Catalog schema that the model is registered to & the local test's response cache is stored in
+############
+uc_catalog = "catalog"
+uc_schema = "schema"
+
+# Set to "true" to load & invoke the logged chain locally before registering it.  Leave as "false" to skip straight to registration & deployment.
+dbutils.widgets.dropdown("run_local_test", "false", ["true", "false"], "Run local test")
+RUN_LOCAL_TEST = dbutils.widgets.get("run_local_test") == "true"
+
+# Set to "true" to have the "Wait for the deployment" cell block (for up to 15 minutes) until the deployed chain is ready.
+dbutils.widgets.dropdown("wait_for_deployment", "false", ["true", "false"], "Wait for deployment")
+WAIT_FOR_DEPLOYMENT = dbutils.widgets.get("wait_for_deployment") == "true"
+
 # COMMAND ----------
 
 # DBTITLE 1,Log the model
@@ -50,10 +98,16 @@ print(f"Saving chain from: {chain_notebook_path}")
 # The model is logged to the Notebook's MLflow Experiment as a run
 ############
 
-logged_chain_info = rag_studio.log_model(code_path=chain_notebook_path)
+# Look up the workspace hostname used by parse_deployment_info in the background while the chain is logged
+with ThreadPoolExecutor(max_workers=1) as executor:
+  hostname_future = executor.submit(du.get_browser_hostname)
+  logged_chain_info = rag_studio.log_model(code_path=chain_notebook_path)
+  _BROWSER_URL = hostname_future.result()
 
-print(f"MLflow Run: {logged_chain_info.run_id}")
-print(f"Model URI: {logged_chain_info.model_uri}")
+print("\n".join([
+  f"MLflow Run: {logged_chain_info.run_id}",
+  f"Model URI: {logged_chain_info.model_uri}",
+]))
 
 ############
 # If you see this error, go to your chain code and comment out all usage of `dbutils`
@@ -62,9 +116,117 @@ print(f"Model URI: {logged_chain_info.model_uri}")
 
 # COMMAND ----------
 
+# DBTITLE 1,Client-side rate limiting
+############
+# If you adapt this notebook to invoke the chain in a loop (e.g., over an evaluation set), a token bucket keeps requests just under the endpoint's
+# requests-per-minute & tokens-per-minute limits instead of hitting 429s and backing off.
+# When invoking from Spark, divide the limits on the driver by the number of tasks that run at once, then build each task's bucket inside the
+# function Spark runs from those plain numbers - a bucket holds a lock, so it can't be pickled into a Spark closure.  For example:
+#   task_requests_per_minute, task_tokens_per_minute = 60 / num_partitions, 100000 / num_partitions
+#   def invoke_partition(rows):
+#     bucket = TokenBucket(task_requests_per_minute, task_tokens_per_minute)
+#     ...
+############
+import json
+import threading
+
+class TokenBucket:
+  def __init__(self, requests_per_minute, tokens_per_minute):
+    # acquire() divides by both rates when it has to wait
+    if requests_per_minute <= 0 or tokens_per_minute <= 0:
+      raise Exception(f"requests_per_minute ({requests_per_minute}) and tokens_per_minute ({tokens_per_minute}) must be greater than 0.")
+    self.request_rate = requests_per_minute / 60
+    self.token_rate = tokens_per_minute / 60
+    self.request_tokens = requests_per_minute
+    self.token_tokens = tokens_per_minute
+    self.max_request_tokens = requests_per_minute
+    self.max_token_tokens = tokens_per_minute
+    self.last_refill = time.monotonic()
+    self.lock = threading.Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    elapsed = now - self.last_refill
+    self.request_tokens = min(self.max_request_tokens, self.request_tokens + elapsed * self.request_rate)
+    self.token_tokens = min(self.max_token_tokens, self.token_tokens + elapsed * self.token_rate)
+    self.last_refill = now
+
+  def acquire(self, estimated_tokens=0):
+    # A single request larger than the bucket can never be satisfied, so cap it at the bucket size
+    estimated_tokens = min(estimated_tokens, self.max_token_tokens)
+    while True:
+      with self.lock:
+        self._refill()
+        if self.request_tokens >= 1 and self.token_tokens >= estimated_tokens:
+          self.request_tokens -= 1
+          self.token_tokens -= estimated_tokens
+          return
+        wait = max(
+          (1 - self.request_tokens) / self.request_rate,
+          (estimated_tokens - self.token_tokens) / self.token_rate,
+        )
+      time.sleep(wait)
+
+rate_limiter = TokenBucket(requests_per_minute=60, tokens_per_minute=100000)
+
+def rate_limited_invoke(model, model_input):
+  rate_limiter.acquire(estimated_tokens=len(json.dumps(model_input)) // 4)
+  return model.invoke(model_input)
+
+# COMMAND ----------
+
+# DBTITLE 1,Response cache for local testing
+############
+# While you iterate on this notebook, responses from the local test below are cached in a Delta Table so re-runs don't call the chain (and its LLM) again.
+# The cache key is a SHA256 of the input and the logged model's contents, so re-logging an unchanged chain still hits the cache.
+# response_cache_mode:
+#   "off": always invoke the chain
+#   "record": return cached responses & cache new ones
+#   "replay": only return cached responses, failing on a miss (useful for reproducible demos)
+############
+import hashlib
+
+response_cache_mode = "record"
+response_cache_table = f"{uc_catalog}.{uc_schema}.hello_world_response_cache"
+
+def _sha256_of_model(local_model_path):
+  # MLmodel holds per-run metadata (run_id, timestamps), so it is left out of the hash
+  digest = hashlib.sha256()
+  for root, dirs, files in os.walk(local_model_path):
+    dirs.sort()
+    for file_name in sorted(files):
+      file_path = os.path.join(root, file_name)
+      if os.path.relpath(file_path, local_model_path) == "MLmodel":
+        continue
+      digest.update(os.path.relpath(file_path, local_model_path).encode())
+      with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+          digest.update(block)
+  return digest.hexdigest()
+
+def cached_invoke(model, model_input, model_sha):
+  if response_cache_mode == "off":
+    return rate_limited_invoke(model, model_input)
+
+  key = hashlib.sha256(json.dumps(model_input, sort_keys=True).encode() + model_sha.encode()).hexdigest()
+  spark.sql(f"CREATE TABLE IF NOT EXISTS {response_cache_table} (key STRING, response STRING)")
+  cached = spark.read.table(response_cache_table).filter(f"key = '{key}'").select("response").take(1)
+  if cached:
+    return json.loads(cached[0].response)
+  if response_cache_mode == "replay":
+    raise Exception(f"No cached response in `{response_cache_table}` for this input.  Run once with response_cache_mode = \"record\" to cache it.")
+
+  response = rate_limited_invoke(model, model_input)
+  spark.createDataFrame([(key, json.dumps(response))], "key STRING, response STRING").createOrReplaceTempView("response_cache_updates")
+  spark.sql(f"""MERGE INTO {response_cache_table} AS cache USING response_cache_updates AS updates ON cache.key = updates.key
+  WHEN NOT MATCHED THEN INSERT *""")
+  return response
+
+# COMMAND ----------
+
 # DBTITLE 1,Run the logged model locally
 ############
-# You can test the model locally
+# You can test the model locally by setting the `Run local test` widget to "true"
 # This is the same input that the REST API will accept once deployed.
 ############
 example_input = {
@@ -84,8 +246,16 @@ example_input = {
     ]
 }
 
-model = mlflow.langchain.load_model(logged_chain_info.model_uri)
-model.invoke(example_input)
+# Download the model's artifacts once (files are fetched in parallel); the content hash is also used when registering the model below
+local_model_path = mlflow.artifacts.download_artifacts(artifact_uri=logged_chain_info.model_uri)
+model_sha = _sha256_of_model(local_model_path)
+
+if RUN_LOCAL_TEST:
+  # Imported next to the only code that uses it, to make clear where the LangChain flavor comes from
+  import mlflow.langchain
+
+  model = mlflow.langchain.load_model(local_model_path)
+  display(cached_invoke(model, example_input, model_sha))
 
 # COMMAND ----------
 
@@ -97,14 +267,61 @@ model.invoke(example_input)
 
 ############
 # To deploy the model, first register the chain from the MLflow Run as a Unity Catalog model.
+# The model is registered to the `uc_catalog` & `uc_schema` set in the Setup cell.
 ############
-uc_catalog = "catalog"
-uc_schema = "schema"
 model_name = "hello_world"
 uc_model_fqdn = f"{uc_catalog}.{uc_schema}.{model_name}" 
 
+if uc_model_fqdn.count('.') != 2 or '' in uc_model_fqdn.split('.', 2):
+  raise Exception(f"`{uc_model_fqdn}` is not a valid Unity Catalog model name.  Use the form `catalog.schema.model_name`.")
+
 mlflow.set_registry_uri('databricks-uc')
-uc_registered_chain_info = mlflow.register_model(logged_chain_info.model_uri, uc_model_fqdn)
+
+# Only register a new version when the chain's contents changed - otherwise, re-use the version already registered with the same content hash.
+from mlflow.exceptions import RestException
+
+client = mlflow.tracking.MlflowClient()
+
+def _search_all_model_versions(name):
+  # Page through every version.  Unity Catalog looks the model up first, so a model that hasn't been registered yet raises rather than returning no versions.
+  versions = []
+  page_token = None
+  try:
+    while True:
+      page = client.search_model_versions(f"name='{name}'", page_token=page_token)
+      versions.extend(page)
+      page_token = page.token
+      if not page_token:
+        return versions
+  except RestException as e:
+    if e.error_code == "RESOURCE_DOES_NOT_EXIST":
+      return []
+    raise
+
+existing_versions = [
+  version for version in _search_all_model_versions(uc_model_fqdn)
+  if version.tags.get("src_sha") == model_sha
+]
+if existing_versions:
+  uc_registered_chain_info = max(existing_versions, key=lambda version: int(version.version))
+  print(f"{uc_model_fqdn} version {uc_registered_chain_info.version} already contains this chain, skipping registration.")
+else:
+  uc_registered_chain_info = mlflow.register_model(logged_chain_info.model_uri, uc_model_fqdn, await_registration_for=0, tags={"src_sha": model_sha})
+
+# Rather than blocking here until the new version is READY, wait for it in the background - the deploy step below only waits when it needs the version.
+def _wait_for_model_version(name, version):
+  client = mlflow.tracking.MlflowClient()
+  def is_ready():
+    status = client.get_model_version(name, version).status
+    if status == "FAILED_REGISTRATION":
+      raise Exception(f"Registration of {name} version {version} failed.")
+    return status == "READY"
+  if not _wait_with_backoff(is_ready):
+    raise Exception(f"Timed out waiting for {name} version {version} to be READY.")
+  return version
+
+registration_executor = ThreadPoolExecutor(max_workers=1)
+registration_future = registration_executor.submit(_wait_for_model_version, uc_model_fqdn, uc_registered_chain_info.version)
 
 # COMMAND ----------
 
@@ -116,6 +333,7 @@ uc_registered_chain_info = mlflow.register_model(logged_chain_info.model_uri, uc
 # 3) Feedback REST API endpoint to pass feedback back from your front end.
 ############
 
+registration_future.result()
 deployment_info = rag_studio.deploy_model(uc_model_fqdn, uc_registered_chain_info.version)
 print(parse_deployment_info(deployment_info))
 
@@ -123,11 +341,47 @@ print(parse_deployment_info(deployment_info))
 
 # COMMAND ----------
 
+# DBTITLE 1,Wait for the deployment
+############
+# Set the `Wait for deployment` widget to "true" to wait for the deployment to finish rather than re-running list_deployments() by hand.
+# The endpoint's status is polled with exponential backoff (5 seconds, growing to at most 60 seconds between checks) for up to 15 minutes.
+############
+import mlflow.deployments
+
+def _wait_for_deployment(deployment_info, initial=5, max_interval=60, timeout=900):
+  deploy_client = mlflow.deployments.get_deploy_client("databricks")
+  def is_ready():
+    endpoint = deploy_client.get_endpoint(deployment_info.endpoint_name)
+    state = endpoint.get("state", {})
+    if state.get("config_update") == "UPDATE_FAILED":
+      raise Exception(f"Deployment of {deployment_info.model_name} version {deployment_info.model_version} failed - check its status at https://{_BROWSER_URL}/ml/endpoints/{deployment_info.endpoint_name}")
+    # An existing endpoint stays READY on its old config while the new version is rolled out, so also wait for the config update to finish
+    # & for the live config to serve this version (the update may not have been registered yet when the endpoint is first polled)
+    served_versions = {str(entity.get("entity_version")) for entity in endpoint.get("config", {}).get("served_entities", [])}
+    return (
+      state.get("ready") == "READY"
+      and state.get("config_update") != "IN_PROGRESS"
+      and str(deployment_info.model_version) in served_versions
+    )
+  return _wait_with_backoff(is_ready, initial=initial, max_interval=max_interval, timeout=timeout)
+
+if WAIT_FOR_DEPLOYMENT:
+  if _wait_for_deployment(deployment_info):
+    print(f"Deployment of {deployment_info.model_name} version {deployment_info.model_version} is ready.")
+  else:
+    print(f"Deployment of {deployment_info.model_name} version {deployment_info.model_version} is not ready yet - check its status at https://{_BROWSER_URL}/ml/endpoints/{deployment_info.endpoint_name}")
+
+# COMMAND ----------
+
 # DBTITLE 1,View deployments
 ############
 # If you lost the deployment information captured above, you can find it using list_deployments()
 ############
-deployments = rag_studio.list_deployments()
+# Ask the server for only this model version's deployments; older SDK versions don't accept the filter, so fall back to listing all deployments
+try:
+  deployments = rag_studio.list_deployments(model_name=uc_model_fqdn, model_version=uc_registered_chain_info.version)
+except TypeError:
+  deployments = rag_studio.list_deployments()
 for deployment in deployments:
   if deployment.model_name == uc_model_fqdn and deployment.model_version==uc_registered_chain_info.version:
     print(parse_deployment_info(deployment))
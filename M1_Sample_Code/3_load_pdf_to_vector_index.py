@@ -10,6 +10,7 @@
 # MAGIC - This pipeline resets the index every time, mirroring the index to the files in the UC Volume.  A future iteration will only update added/changed/removed files.
 # MAGIC - Splitting based on tokens requires a cluster with internet access.  If you do not have internet access on your cluster, adjust the gold parsing step.
 # MAGIC - Can't change column names in the Vector Index after the tables are initially created - to change column names, delete the Vector Index and re-sync.
+# MAGIC   - The gold table no longer includes the `modificationTime` & `length` columns, so indexes created by earlier versions of this notebook must be deleted and re-synced.  The notebook stops before writing the gold table if it detects this.
 
 # COMMAND ----------
 
@@ -29,12 +30,20 @@
 
 # COMMAND ----------
 
-# MAGIC %pip install -U --quiet pypdf==4.1.0 databricks-sdk langchain==0.1.13
+# MAGIC %pip install -U --quiet pymupdf==1.24.1 pypdf==4.1.0 xxhash==3.4.1 databricks-sdk langchain==0.1.13
 # MAGIC dbutils.library.restartPython()
 
 # COMMAND ----------
 
-import io
+import os
+import sys
+import types
+import hashlib
+import xxhash
+import signal
+import threading
+import multiprocessing
+import pyarrow as pa
 from databricks.sdk import WorkspaceClient
 from databricks.sdk.errors import NotFound, ResourceDoesNotExist
 from databricks.sdk.service.vectorsearch import (
@@ -48,11 +57,13 @@ from databricks.sdk.service.vectorsearch import (
 import pyspark.sql.functions as func
 from pyspark.sql.types import MapType, StringType
 from pypdf import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
-from pyspark.sql import Column
+import fitz  # PyMuPDF
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pyspark import StorageLevel, TaskContext
+from pyspark.sql import Column, Window
 from pyspark.sql.types import *
 from datetime import timedelta
-from typing import List
+from typing import Iterator, List
 import warnings
 
 # Init workspace client
@@ -198,9 +209,15 @@ FMAPI_EMBEDDINGS_TASK = "llm/v1/embeddings"
 bronze_raw_files_table_name = (
     f"{uc_catalog_name}.{uc_schema_name}.bronze_{volume_raw_name}_raw"
 )
+bronze_skipped_files_table_name = (
+    f"{uc_catalog_name}.{uc_schema_name}.bronze_{volume_raw_name}_skipped"
+)
 silver_parsed_files_table_name = (
     f"{uc_catalog_name}.{uc_schema_name}.silver_{volume_raw_name}_parsed"
 )
+silver_parse_errors_table_name = (
+    f"{uc_catalog_name}.{uc_schema_name}.silver_{volume_raw_name}_parse_errors"
+)
 gold_chunks_table_name = (
     f"{uc_catalog_name}.{uc_schema_name}.gold_{volume_raw_name}_chunked"
 )
@@ -208,8 +225,10 @@ gold_chunks_index_name = (
     f"{uc_catalog_name}.{uc_schema_name}.gold_{volume_raw_name}_chunked_index"
 )
 
-print(f"Bronze Delta Table w/ raw files: `{bronze_raw_files_table_name}`")
-print(f"Silver Delta Table w/ parsed files: `{silver_parsed_files_table_name}`")
+print(f"Bronze Delta Table w/ file metadata: `{bronze_raw_files_table_name}`")
+print(f"Bronze Delta Table w/ empty or oversized files that are not parsed: `{bronze_skipped_files_table_name}`")
+print(f"Silver Delta Table w/ parsed files (only written if `WRITE_SILVER_PARSED_TABLE = True`): `{silver_parsed_files_table_name}`")
+print(f"Silver Delta Table w/ files that failed to parse: `{silver_parse_errors_table_name}`")
 print(f"Gold Delta Table w/ chunked files: `{gold_chunks_table_name}`")
 print(f"Vector Search Index mirror of Gold Delta Table: `{gold_chunks_index_name}`")
 print("--")
@@ -318,9 +337,15 @@ else:
 # bronze_raw_files_table_name = (
 #     f"{uc_catalog_name}.{uc_schema_name}.bronze_{volume_raw_name}_raw"
 # )
+# bronze_skipped_files_table_name = (
+#     f"{uc_catalog_name}.{uc_schema_name}.bronze_{volume_raw_name}_skipped"
+# )
 # silver_parsed_files_table_name = (
 #     f"{uc_catalog_name}.{uc_schema_name}.silver_{volume_raw_name}_parsed"
 # )
+# silver_parse_errors_table_name = (
+#     f"{uc_catalog_name}.{uc_schema_name}.silver_{volume_raw_name}_parse_errors"
+# )
 # gold_chunks_table_name = (
 #     f"{uc_catalog_name}.{uc_schema_name}.gold_{volume_raw_name}_chunked"
 # )
@@ -328,8 +353,10 @@ else:
 #     f"{uc_catalog_name}.{uc_schema_name}.gold_{volume_raw_name}_chunked_index"
 # )
 # print("--")
-# print(f"Bronze Delta Table w/ raw files: `{bronze_raw_files_table_name}`")
-# print(f"Silver Delta Table w/ parsed files: `{silver_parsed_files_table_name}`")
+# print(f"Bronze Delta Table w/ file metadata: `{bronze_raw_files_table_name}`")
+# print(f"Bronze Delta Table w/ empty or oversized files that are not parsed: `{bronze_skipped_files_table_name}`")
+# print(f"Silver Delta Table w/ parsed files (only written if `WRITE_SILVER_PARSED_TABLE = True`): `{silver_parsed_files_table_name}`")
+# print(f"Silver Delta Table w/ files that failed to parse: `{silver_parse_errors_table_name}`")
 # print(f"Gold Delta Table w/ chunked files: `{gold_chunks_table_name}`")
 # print(f"Vector Search Index mirror of Gold Delta Table: `{gold_chunks_index_name}`")
 # print("--")
@@ -373,6 +400,8 @@ bronze_df = (
     .option("recursiveFileLookup", "true")
     .option("pathGlobFilter", "*.pdf")
     .load(source_uc_volume)
+    # Only the file metadata is kept, so the files' bytes are never read here - the parsing step opens each file from the volume itself
+    .drop("content")
 )
 
 bronze_df = bronze_df.selectExpr(f"* except({LOADER_DEFAULT_DOC_URI_COL_NAME})", f"{LOADER_DEFAULT_DOC_URI_COL_NAME} as {DOC_URI_COL_NAME}")
@@ -384,7 +413,7 @@ bronze_df = spark.read.table(bronze_raw_files_table_name)
 
 display(bronze_df.selectExpr(f"{DOC_URI_COL_NAME}", "modificationTime", "length"))
 
-if bronze_df.count() == 0:
+if not bronze_df.take(1):
     url = f"https://{dbutils.notebook.entry_point.getDbutils().notebook().getContext().browserHostName().get()}/explore/data{source_uc_volume}/"
     display(f"`{source_uc_volume}` does not contain any PDF files.  Open the volume and upload at least 1 PDF file: {url}")
     raise Exception(f"`{source_uc_volume}` does not contain any PDF files.")
@@ -394,74 +423,187 @@ if bronze_df.count() == 0:
 # MAGIC %md
 # MAGIC ## Silver: Parse the PDF files into text
 # MAGIC
-# MAGIC If you want to change the parsing library or adjust it's settings, modify the contents of the `parse_pdf` UDF.
+# MAGIC By default, PDFs are parsed with PyMuPDF, which is considerably faster than pypdf.  Set `PDF_PARSER = "pypdf"` to use pypdf instead (e.g., if PyMuPDF's AGPL license doesn't work for you).
+# MAGIC
+# MAGIC If you want to change the parsing library or adjust it's settings, modify the contents of the `_parse_one_pdf` function.
+# MAGIC
+# MAGIC To avoid writing the full text of every document to a Delta Table only to read it back, the PDFs are parsed and chunked in a single pass in the Gold step below.  To save the parsed text to the silver table (e.g., to debug parsing), set `WRITE_SILVER_PARSED_TABLE = True`.
 
 # COMMAND ----------
 
 # DBTITLE 1,Optimized PDF Parsing Function
-# If using runtime < 14.3, remove `useArrow=True`
-# useArrow=True which optimizes performance only works with 14.3+
-
-@func.udf(
-    returnType=StructType(
-        [
-            StructField("number_pages", IntegerType(), nullable=True),
-            StructField("text", StringType(), nullable=True),
-            StructField("status", StringType(), nullable=False),
-        ]
-    ),
-    # useArrow=True, # set globally
-)
-def parse_pdf(pdf_raw_bytes):
+# Parsing runs in `parse_and_chunk` (below) with `mapInArrow`: Spark sends it whole Arrow batches of file paths, so the JVM <-> Python round trip is paid once per batch rather than once per file.
+# Each row is an entire PDF file to parse, so parsing uses batches far smaller than the default of 10,000 rows.  This is only set while the parse runs so other Arrow stages keep the cluster's setting.
+PARSE_ARROW_MAX_RECORDS_PER_BATCH = 32
+
+# "pymupdf" or "pypdf"
+PDF_PARSER = "pymupdf"
+
+# Files larger than this are not parsed - they are saved to the `bronze_skipped_files_table_name` table for review
+MAX_PDF_BYTES = 50 * 1024 * 1024
+# Give up on any single file that takes longer than this to parse
+PDF_PARSE_TIMEOUT_SECONDS = 300
+# Target number of files per parsing task - smaller values spread large files across more tasks
+FILES_PER_PARSE_TASK = 8
+
+def _doc_uri_to_local_path(doc_uri):
+    # UC Volumes are mounted at `/Volumes` on every node, so `dbfs:/Volumes/...` can be opened as a local file
+    return doc_uri[len("dbfs:"):] if doc_uri.startswith("dbfs:") else doc_uri
+
+def _parse_with_pymupdf(pdf_path):
+    doc = fitz.open(pdf_path, filetype="pdf")
     try:
-        pdf = io.BytesIO(pdf_raw_bytes)
-        reader = PdfReader(pdf)
-        output_text = ""
-        for _, page_content in enumerate(reader.pages):
-            output_text += page_content.extract_text() + "\n\n"
+        # Pages that reference no fonts (e.g., scanned images) have no text, so skip running the extractor on them
+        output_text = "\n\n".join(page.get_text("text") if page.get_fonts() else "" for page in doc)
+        return doc.page_count, output_text
+    finally:
+        doc.close()
+
+def _pypdf_page_may_have_text(page_content):
+    # Text needs a font, either in the page's resources or in a form XObject the page draws
+    resources = page_content.get("/Resources")
+    if resources is None:
+        return False
+    resources = resources.get_object()
+    if "/Font" in resources:
+        return True
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return False
+    return any(xobject.get_object().get("/Subtype") == "/Form" for xobject in xobjects.get_object().values())
+
+def _parse_with_pypdf(pdf_path):
+    reader = PdfReader(pdf_path)
+    output_text = "\n\n".join(
+        page_content.extract_text() if _pypdf_page_may_have_text(page_content) else ""
+        for page_content in reader.pages
+    )
+    return len(reader.pages), output_text
+
+class _ParseTimeout(Exception):
+    pass
+
+def _raise_parse_timeout(signum, frame):
+    raise _ParseTimeout(f"Parsing took longer than {PDF_PARSE_TIMEOUT_SECONDS} seconds")
+
+def _parse_one_pdf(doc_uri):
+    # SIGALRM is only available on Unix, and only to the main thread.  Python only handles the signal between bytecodes, so this only interrupts
+    # parsing that is running Python code (e.g., pypdf) - `_parse_pdfs` enforces the timeout for files stuck inside PyMuPDF's C code.
+    use_alarm = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_parse_timeout)
+        signal.alarm(PDF_PARSE_TIMEOUT_SECONDS)
+    try:
+        if PDF_PARSER == "pymupdf":
+            number_pages, output_text = _parse_with_pymupdf(_doc_uri_to_local_path(doc_uri))
+        else:
+            number_pages, output_text = _parse_with_pypdf(_doc_uri_to_local_path(doc_uri))
 
         return {
-            "number_pages": len(reader.pages),
+            "number_pages": number_pages,
             "text": output_text,
             "status": "SUCCESS",
         }
     except Exception as e:
         return {"number_pages": None, "text": None, "status": f"ERROR: {e}"}
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
 
 
-# Run the parsing
-df_parsed = bronze_df.withColumn("parsed_output", parse_pdf("content")).drop("content")
+def _task_cpus():
+    # Spark runs one Python task per `spark.task.cpus` cores
+    task_context = TaskContext.get()
+    return max(1, task_context.cpus() if task_context is not None else 1)
 
-# Check and warn on any errors
-num_errors = df_parsed.filter(func.col("parsed_output.status") != "SUCCESS").count()
-if num_errors > 0:
-    warning.warn(f"{num_errors} documents had parse errors.  Please review.")
+def _start_parse_pool():
+    # Files are always parsed in child processes, so a file that hangs can be killed.  Start one parsing process per core the task was given.
+    num_workers = _task_cpus()
+    try:
+        # Pool workers look up the function to run by name on `__main__`, where this notebook's functions don't live on Spark executors
+        setattr(sys.modules["__main__"], _parse_one_pdf.__name__, _parse_one_pdf)
+        return multiprocessing.get_context("fork").Pool(num_workers)
+    except Exception as e:
+        warnings.warn(f"Could not start a PDF parsing pool, parsing sequentially instead (files stuck in PyMuPDF won't time out): {e}")
+        return None
+
+
+def _parse_pdfs(pool, doc_uris):
+    # Returns the parsed PDFs and the pool to keep using - None if the pool failed and parsing fell back to running sequentially
+    parsed = []
+    while pool is not None and len(parsed) < len(doc_uris):
+        try:
+            # Workers take files in order, so once the files before it are done, a file has been running for at least as long as its result is waited on
+            pending = [pool.apply_async(_parse_one_pdf, (doc_uri,)) for doc_uri in doc_uris[len(parsed):]]
+            for result in pending:
+                parsed.append(result.get(timeout=PDF_PARSE_TIMEOUT_SECONDS))
+        except multiprocessing.TimeoutError:
+            # The worker is stuck where SIGALRM can't interrupt it, so kill the pool & parse the rest of the files in a new one
+            parsed.append({"number_pages": None, "text": None, "status": f"ERROR: Parsing took longer than {PDF_PARSE_TIMEOUT_SECONDS} seconds"})
+            pool.terminate()
+            pool = _start_parse_pool()
+        except Exception as e:
+            warnings.warn(f"PDF parsing pool failed, parsing sequentially instead (files stuck in PyMuPDF won't time out): {e}")
+            pool.terminate()
+            pool = None
+    parsed += [_parse_one_pdf(doc_uri) for doc_uri in doc_uris[len(parsed):]]
+    return parsed, pool
+
+
+# Set aside empty & oversized files rather than parsing them
+parse_size_filter = (func.col("length") > 0) & (func.col("length") <= MAX_PDF_BYTES)
+
+bronze_skipped_df = bronze_df.filter(~parse_size_filter).withColumn(
+    "skip_reason",
+    func.when(func.col("length") == 0, "EMPTY").otherwise(f"LARGER_THAN_{MAX_PDF_BYTES}_BYTES"),
+)
+bronze_skipped_df.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(bronze_skipped_files_table_name)
 
-df_parsed.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(silver_parsed_files_table_name)
+num_skipped = spark.read.table(bronze_skipped_files_table_name).count()
+if num_skipped > 0:
+    warnings.warn(f"{num_skipped} documents were empty or larger than {MAX_PDF_BYTES} bytes and were not parsed.  See `{bronze_skipped_files_table_name}`.")
 
-# reload to get correct lineage in UC and to filter out any error rows for the downstream step.
-df_parsed = spark.read.table(silver_parsed_files_table_name).filter(
-    func.col("parsed_output.status") == "SUCCESS"
+# Balance the parsing work across partitions by file size: deal the files out to partitions largest first, round-robin, so each partition gets a similar mix of large & small files.
+num_files_to_parse = bronze_df.filter(parse_size_filter).count()
+try:
+    min_parse_partitions = spark.sparkContext.defaultParallelism
+except Exception:
+    # `sparkContext` isn't available on Shared access mode / Spark Connect clusters, so use the shuffle partitions setting (Spark's default is 200)
+    shuffle_partitions = spark.conf.get("spark.sql.shuffle.partitions", "200")
+    min_parse_partitions = int(shuffle_partitions) if shuffle_partitions.isdigit() else 200
+# Never more partitions than files, so small volumes don't launch empty parsing tasks
+num_parse_partitions = max(1, min(num_files_to_parse, max(min_parse_partitions, num_files_to_parse // FILES_PER_PARSE_TASK)))
+
+bronze_to_parse_df = (
+    bronze_df.filter(parse_size_filter)
+    .withColumn(
+        "parse_partition",
+        func.row_number().over(Window.orderBy(func.col("length").desc())) % num_parse_partitions,
+    )
+    .repartitionByRange(num_parse_partitions, "parse_partition")
+    .drop("parse_partition")
 )
 
-display(df_parsed)
-
 # COMMAND ----------
 
-# MAGIC %md ## Gold: Chunk the parsed text
+# MAGIC %md ## Gold: Parse & chunk the files
+# MAGIC
+# MAGIC Each PDF is parsed, split into chunks, and each chunk given an id (a hash of its text) in a single pass over each Arrow batch of files, `parse_and_chunk`.
 # MAGIC
 # MAGIC If you change your embedding model, you will need to adjust the tokenizer accordingly.
 # MAGIC
-# MAGIC If you are using a cluster without internet access, remove the below cell and replace the udf with
+# MAGIC If you are using a cluster without internet access, remove the tokenizer test cell below and replace `_get_tokenizer` & `_split_by_tokens` with
 # MAGIC
 # MAGIC ```
-# MAGIC @func.udf(returnType=ArrayType(StringType()), useArrow=True)
-# MAGIC def split_char_recursive(content: str) -> List[str]:
-# MAGIC     text_splitter = RecursiveCharacterTextSplitter(
-# MAGIC         chunk_size=chunk_size, chunk_overlap=chunk_overlap
+# MAGIC def _get_tokenizer():
+# MAGIC     # Built once per task & passed to `_split_by_tokens` for every batch of files
+# MAGIC     return RecursiveCharacterTextSplitter(
+# MAGIC         chunk_size=chunk_size_tokens, chunk_overlap=chunk_overlap_tokens
 # MAGIC     )
-# MAGIC     chunks = text_splitter.split_text(content)
-# MAGIC     return [doc for doc in chunks]
+# MAGIC
+# MAGIC def _split_by_tokens(text_splitter, contents: List[str]) -> List[List[str]]:
+# MAGIC     return [text_splitter.split_text(content) for content in contents]
 # MAGIC ```
 
 # COMMAND ----------
@@ -472,11 +614,12 @@ display(df_parsed)
 
 from transformers import AutoTokenizer
 
-tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-large-en-v1.5')
+TOKENIZER_NAME = 'BAAI/bge-large-en-v1.5'
 
 # Test the tokenizer
+test_tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, use_fast=True)
 chunk_example_text = "this is some text in a chunk"
-encoded_input = tokenizer(chunk_example_text, padding=True, truncation=True, return_tensors='pt')
+encoded_input = test_tokenizer(chunk_example_text, padding=True, truncation=True, return_tensors='pt')
 print(f"Number of tokens in `{chunk_example_text}`: {len(encoded_input['input_ids'][0])}")
 
 # COMMAND ----------
@@ -485,30 +628,201 @@ print(f"Number of tokens in `{chunk_example_text}`: {len(encoded_input['input_id
 CHUNK_COLUMN_NAME = "chunked_text"
 CHUNK_ID_COLUMN_NAME = "chunk_id"
 
-# If using runtime < 14.3, remove `useArrow=True`
-# useArrow=True which optimizes performance only works with 14.3+
+# Set to True to also save each document's parsed text to the silver table, e.g., to debug parsing
+WRITE_SILVER_PARSED_TABLE = False
+
+# Chunk ids only need to be stable, not cryptographically secure, so they default to the much faster xxHash (XXH3, 64 bit).
+# Set to "md5" to keep the MD5 chunk ids created by earlier versions of this notebook (e.g., if your evaluation set references them).
+CHUNK_ID_HASH = "xxh3_64"
+
+if chunk_overlap_tokens >= chunk_size_tokens:
+    raise Exception(f"chunk_overlap_tokens ({chunk_overlap_tokens}) must be smaller than chunk_size_tokens ({chunk_size_tokens}).")
+
+# The tokenizer is loaded by each executor Python worker the first time it's needed, rather than being pickled from the driver and shipped with every task.
+# This notebook's functions are unpickled with fresh globals in every task, so the tokenizer is cached on a module in `sys.modules`, which lives as long as the worker.
+# The fast (Rust) tokenizer returns each token's character offsets, which are used to cut the text.
+_TOKENIZER_CACHE_MODULE_NAME = "_pdf_chunking_tokenizer_cache"
+
+def _get_tokenizer():
+    tokenizer_cache = sys.modules.setdefault(_TOKENIZER_CACHE_MODULE_NAME, types.ModuleType(_TOKENIZER_CACHE_MODULE_NAME))
+    if getattr(tokenizer_cache, "tokenizer_name", None) != TOKENIZER_NAME:
+        from transformers import AutoTokenizer
+        tokenizer_cache.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, use_fast=True)
+        tokenizer_cache.tokenizer_name = TOKENIZER_NAME
+    return tokenizer_cache.tokenizer
+
+# Tokenize a whole batch of documents in one call (the fast tokenizer encodes them in parallel when the task has several cores), then cut each document into windows of
+# `chunk_size_tokens` tokens that overlap by `chunk_overlap_tokens` tokens, using the character offsets of the first & last token in each window.
+def _split_by_tokens(tokenizer, contents: List[str]) -> List[List[str]]:
+    if not contents:
+        return []
+    offset_mappings = tokenizer(
+        contents, add_special_tokens=False, return_offsets_mapping=True, truncation=False
+    )["offset_mapping"]
+    stride = chunk_size_tokens - chunk_overlap_tokens
+    all_chunks = []
+    for content, offsets in zip(contents, offset_mappings):
+        chunks = []
+        for start in range(0, len(offsets), stride):
+            window = offsets[start : start + chunk_size_tokens]
+            chunks.append(content[window[0][0] : window[-1][1]])
+            if start + chunk_size_tokens >= len(offsets):
+                break
+        all_chunks.append(chunks)
+    return all_chunks
+
+def _chunk_id(chunk):
+    if CHUNK_ID_HASH == "md5":
+        return hashlib.md5(chunk.encode("utf-8"), usedforsecurity=False).hexdigest()
+    return xxhash.xxh3_64_hexdigest(chunk.encode("utf-8"))
+
+def _chunk_with_ids(tokenizer, texts):
+    return [
+        [{CHUNK_COLUMN_NAME: chunk, CHUNK_ID_COLUMN_NAME: _chunk_id(chunk)} for chunk in chunks]
+        for chunks in _split_by_tokens(tokenizer, texts)
+    ]
+
+# `parse_and_chunk` runs on the Arrow record batches of the bronze rows directly (via `mapInArrow`): the metadata columns are passed through as-is
+# & the parse/chunk results are written straight into Arrow arrays, rather than going through pandas & a struct-typed UDF column.
+CHUNK_ARROW_TYPE = pa.struct(
+    [
+        pa.field(CHUNK_COLUMN_NAME, pa.string(), nullable=False),
+        pa.field(CHUNK_ID_COLUMN_NAME, pa.string(), nullable=False),
+    ]
+)
+PARSED_OUTPUT_ARROW_FIELDS = [
+    pa.field("number_pages", pa.int32(), nullable=True),
+    pa.field("text", pa.string(), nullable=True),
+    pa.field("status", pa.string(), nullable=False),
+    pa.field("chunks", pa.list_(CHUNK_ARROW_TYPE), nullable=True),
+]
+BRONZE_METADATA_COLUMNS = [DOC_URI_COL_NAME, "modificationTime", "length"]
+
+parsed_schema = StructType(
+    [
+        StructField(DOC_URI_COL_NAME, StringType(), nullable=True),
+        StructField("modificationTime", TimestampType(), nullable=True),
+        StructField("length", LongType(), nullable=True),
+        StructField(
+            "parsed_output",
+            StructType(
+                [
+                    StructField("number_pages", IntegerType(), nullable=True),
+                    StructField("text", StringType(), nullable=True),
+                    StructField("status", StringType(), nullable=False),
+                    StructField(
+                        "chunks",
+                        ArrayType(
+                            StructType(
+                                [
+                                    StructField(CHUNK_COLUMN_NAME, StringType(), nullable=False),
+                                    StructField(CHUNK_ID_COLUMN_NAME, StringType(), nullable=False),
+                                ]
+                            ),
+                            containsNull=False,
+                        ),
+                        nullable=True,
+                    ),
+                ]
+            ),
+            nullable=False,
+        ),
+    ]
+)
 
-# TODO: Add error handling
-@func.udf(returnType=ArrayType(StringType())
-          # useArrow=True, # set globally
-          )
-def split_char_recursive(content: str) -> List[str]:
-    text_splitter = CharacterTextSplitter.from_huggingface_tokenizer(
-        tokenizer, chunk_size=chunk_size_tokens, chunk_overlap=chunk_overlap_tokens
-    )
-    chunks = text_splitter.split_text(content)
-    return [doc for doc in chunks]
+def parse_and_chunk(record_batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    # The fast tokenizer encodes batches on a thread pool sized to every core of the machine by default, which oversubscribes the CPU when Spark runs a
+    # task per core.  Only let it use the cores this task was given (the thread pool reads RAYON_NUM_THREADS when the tokenizer first uses it).
+    # TOKENIZERS_PARALLELISM is otherwise left to the tokenizer's default, which turns parallelism off in the forked parsing processes.
+    task_cpus = _task_cpus()
+    if task_cpus > 1:
+        os.environ.setdefault("RAYON_NUM_THREADS", str(task_cpus))
+    else:
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    # The pool & tokenizer are only started once there are files to parse, so partitions without any rows don't pay for them
+    started = False
+    pool = None
+    try:
+        for record_batch in record_batches:
+            if record_batch.num_rows == 0:
+                continue
+            if not started:
+                pool = _start_parse_pool()
+                tokenizer = _get_tokenizer()
+                started = True
+            parsed, pool = _parse_pdfs(pool, record_batch.column(DOC_URI_COL_NAME).to_pylist())
+            parsed_ok = [parsed_pdf for parsed_pdf in parsed if parsed_pdf["status"] == "SUCCESS"]
+            for parsed_pdf, chunks in zip(parsed_ok, _chunk_with_ids(tokenizer, [parsed_pdf["text"] for parsed_pdf in parsed_ok])):
+                parsed_pdf["chunks"] = chunks
+            for parsed_pdf in parsed:
+                parsed_pdf.setdefault("chunks", None)
+                if not WRITE_SILVER_PARSED_TABLE:
+                    parsed_pdf["text"] = None
+
+            parsed_output = pa.StructArray.from_arrays(
+                [pa.array([parsed_pdf[field.name] for parsed_pdf in parsed], type=field.type) for field in PARSED_OUTPUT_ARROW_FIELDS],
+                fields=PARSED_OUTPUT_ARROW_FIELDS,
+            )
+            yield pa.RecordBatch.from_arrays(
+                [record_batch.column(column) for column in BRONZE_METADATA_COLUMNS] + [parsed_output],
+                names=BRONZE_METADATA_COLUMNS + ["parsed_output"],
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+# Run the parsing & chunking
+# The result is persisted so writing the errors, silver & gold tables below don't each parse every PDF again
+df_parsed = bronze_to_parse_df.select(*BRONZE_METADATA_COLUMNS).mapInArrow(parse_and_chunk, parsed_schema)
+df_parsed = df_parsed.persist(StorageLevel.DISK_ONLY)
+parse_succeeded = func.col("parsed_output.status") == "SUCCESS"
+
+# Save the files that failed to parse to their own table, so the successfully parsed files can be used below without filtering out errors again
+# This is the action that runs the parse, so the small Arrow batch size only needs to be in effect for it
+default_max_records_per_batch = spark.conf.get("spark.sql.execution.arrow.maxRecordsPerBatch")
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(PARSE_ARROW_MAX_RECORDS_PER_BATCH))
+try:
+    df_parsed.filter(~parse_succeeded).select(*BRONZE_METADATA_COLUMNS, func.col("parsed_output.status").alias("status")).write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(silver_parse_errors_table_name)
+finally:
+    spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", default_max_records_per_batch)
+
+# Check and warn on any errors
+num_errors = spark.read.table(silver_parse_errors_table_name).count()
+if num_errors > 0:
+    warnings.warn(f"{num_errors} documents had parse errors.  Please review `{silver_parse_errors_table_name}`.")
+
+df_parsed_ok = df_parsed.filter(parse_succeeded)
 
+if WRITE_SILVER_PARSED_TABLE:
+    df_parsed_ok.withColumn("parsed_output", func.col("parsed_output").dropFields("chunks")).write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(silver_parsed_files_table_name)
+    display(spark.read.table(silver_parsed_files_table_name))
 
-df_chunked = df_parsed.select(
-    "*", func.explode(split_char_recursive("parsed_output.text")).alias(CHUNK_COLUMN_NAME)
-).drop(func.col("parsed_output"))
-df_chunked = df_chunked.select(
-    "*", func.md5(func.col(CHUNK_COLUMN_NAME)).alias(CHUNK_ID_COLUMN_NAME)
+# Give each chunk its own row
+# Vector Search needs 1 row per chunk, so only `doc_uri` is kept alongside each chunk rather than repeating all of the file's metadata on every row
+df_chunked = (
+    df_parsed_ok
+    .select(DOC_URI_COL_NAME, func.explode("parsed_output.chunks").alias("chunk"))
+    .select(DOC_URI_COL_NAME, "chunk.*")
 )
 
+# Vector Search indexes can't follow column changes in their source table, so if this write would change the gold table's columns while an index
+# exists, stop before writing - the gold table is left as is, so every re-run stops here until the index is deleted & re-created.
+previous_gold_columns = spark.read.table(gold_chunks_table_name).columns if spark.catalog.tableExists(gold_chunks_table_name) else None
+if previous_gold_columns is not None and previous_gold_columns != df_chunked.columns:
+    try:
+        w.vector_search_indexes.get_index(gold_chunks_index_name)
+    except NotFound:
+        pass
+    else:
+        df_parsed.unpersist()
+        raise Exception(f"The columns of `{gold_chunks_table_name}` are changing, so `{gold_chunks_index_name}` can't be re-synced.  Delete the index, then re-run this cell to re-create it.")
+
 df_chunked.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(gold_chunks_table_name)
-display(df_chunked)
+df_parsed.unpersist()
+
+display(spark.read.table(gold_chunks_table_name))
 
 # Enable CDC for Vector Search Delta Sync
 spark.sql(f"ALTER TABLE {gold_chunks_table_name} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
@@ -560,8 +874,10 @@ def get_table_url(table_fqdn):
 print("Vector index:\n")
 print(w.vector_search_indexes.get_index(gold_chunks_index_name).status.message)
 print("\nOutput tables:\n")
-print(f"Bronze Delta Table w/ raw files: {get_table_url(bronze_raw_files_table_name)}")
-print(f"Silver Delta Table w/ parsed files: {get_table_url(silver_parsed_files_table_name)}")
+print(f"Bronze Delta Table w/ file metadata: {get_table_url(bronze_raw_files_table_name)}")
+if WRITE_SILVER_PARSED_TABLE:
+    print(f"Silver Delta Table w/ parsed files: {get_table_url(silver_parsed_files_table_name)}")
+print(f"Silver Delta Table w/ files that failed to parse: {get_table_url(silver_parse_errors_table_name)}")
 print(f"Gold Delta Table w/ chunked files: {get_table_url(gold_chunks_table_name)}")
 
 # COMMAND ----------
@@ -10,6 +10,7 @@ dbutils.library.restartPython()
 
 import os
 import mlflow
+from mlflow.entities import RunTag
 from databricks import rag_studio, rag_eval, rag
 import json
 import html
@@ -72,8 +73,13 @@ print(f"Saving chain from: {chain_notebook_path}, config from: {chain_config_pat
 logged_chain_info = rag_studio.log_model(code_path=chain_notebook_path, config_path=chain_config_path)
 
 # Optionally, tag the run to save any additional metadata
-with mlflow.start_run(run_id=logged_chain_info.run_id):
-  mlflow.set_tag(key="your_custom_tag", value="info_about_chain")
+# Tags (and params/metrics) are sent in a single `log_batch` request rather than one request per key
+mlflow.tracking.MlflowClient().log_batch(
+  run_id=logged_chain_info.run_id,
+  params=[],
+  tags=[RunTag(key="your_custom_tag", value="info_about_chain")],
+  metrics=[],
+)
 
 # Save YAML config params to the Run for easy filtering / comparison later(requires experimental import)
 # ⚠️⚠️ 🐛🐛 Experimental features likely have bugs! 🐛🐛 ⚠️⚠️
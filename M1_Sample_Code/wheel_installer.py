@@ -1,3 +1,25 @@
 # Databricks notebook source
+# Snapshot the installed package versions so driver notebooks can tell whether the installs below changed anything
+import importlib
+import importlib.metadata
+
+def _installed_package_versions():
+  # A package can be installed more than once (e.g., a notebook-scoped %pip upgrade over the cluster's copy), so keep the copy that gets imported: the first on sys.path
+  importlib.invalidate_caches()
+  versions = {}
+  for dist in importlib.metadata.distributions():
+    versions.setdefault(dist.metadata["Name"], dist.version)
+  return versions
+
+_packages_before_install = _installed_package_versions()
+
+# COMMAND ----------
+
 # MAGIC %pip install "PUT_RAG_STUDIO_WHEEL_HERE"
 # MAGIC %pip install "PUT_RAG_EVAL_SUITE_WHEEL_HERE"
+
+# COMMAND ----------
+
+# True if the installs above added or upgraded any package (the wheels or any of their dependencies, e.g., mlflow or langchain).
+# Driver notebooks only need to restart Python when this is True: otherwise nothing already imported in this Python process is stale.
+WHEEL_INSTALL_CHANGED_PACKAGES = _installed_package_versions() != _packages_before_install